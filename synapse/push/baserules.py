@@ -14,10 +14,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import copy
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Tuple
 
 from synapse.push.rulekinds import PRIORITY_CLASS_INVERSE_MAP, PRIORITY_CLASS_MAP
+from synapse.util.frozenutils import freeze
+
+# The priority classes, from the highest to the lowest.
+_PRIO_CLASSES_DESC = tuple(sorted(PRIORITY_CLASS_INVERSE_MAP, reverse=True))
 
 
 def list_with_base_rules(
@@ -35,64 +38,30 @@ def list_with_base_rules(
     """
     ruleslist = []
 
-    # Grab the base rules that the user has modified.
-    # The modified base rules have a priority_class of -1.
-    modified_base_rules = {r["rule_id"]: r for r in rawrules if r["priority_class"] < 0}
-
-    # Remove the modified base rules from the list, They'll be added back
-    # in the default positions in the list.
-    rawrules = [r for r in rawrules if r["priority_class"] >= 0]
+    # Grab the base rules that the user has modified, and group the others by
+    # priority class, in a single pass over the list.
+    # The modified base rules have a priority_class of -1. They'll be added
+    # back in the default positions in the list.
+    modified_base_rules = {}  # type: Dict[str, Dict[str, Any]]
+    rules_by_prio_class = {}  # type: Dict[int, List[Dict[str, Any]]]
+    for r in rawrules:
+        if r["priority_class"] < 0:
+            modified_base_rules[r["rule_id"]] = r
+        else:
+            rules_by_prio_class.setdefault(r["priority_class"], []).append(r)
 
-    # shove the server default rules for each kind onto the end of each
-    current_prio_class = list(PRIORITY_CLASS_INVERSE_MAP)[-1]
+    # Walk the priority classes from the highest to the lowest, surrounding the
+    # user's rules for each class with the server default rules of that kind.
+    for prio_class in _PRIO_CLASSES_DESC:
+        kind = PRIORITY_CLASS_INVERSE_MAP[prio_class]
 
-    ruleslist.extend(
-        make_base_prepend_rules(
-            PRIORITY_CLASS_INVERSE_MAP[current_prio_class],
-            modified_base_rules,
-            use_new_defaults,
+        ruleslist.extend(
+            make_base_prepend_rules(kind, modified_base_rules, use_new_defaults)
         )
-    )
-
-    for r in rawrules:
-        if r["priority_class"] < current_prio_class:
-            while r["priority_class"] < current_prio_class:
-                ruleslist.extend(
-                    make_base_append_rules(
-                        PRIORITY_CLASS_INVERSE_MAP[current_prio_class],
-                        modified_base_rules,
-                        use_new_defaults,
-                    )
-                )
-                current_prio_class -= 1
-                if current_prio_class > 0:
-                    ruleslist.extend(
-                        make_base_prepend_rules(
-                            PRIORITY_CLASS_INVERSE_MAP[current_prio_class],
-                            modified_base_rules,
-                            use_new_defaults,
-                        )
-                    )
-
-        ruleslist.append(r)
-
-    while current_prio_class > 0:
+        ruleslist.extend(rules_by_prio_class.get(prio_class, []))
         ruleslist.extend(
-            make_base_append_rules(
-                PRIORITY_CLASS_INVERSE_MAP[current_prio_class],
-                modified_base_rules,
-                use_new_defaults,
-            )
+            make_base_append_rules(kind, modified_base_rules, use_new_defaults)
         )
-        current_prio_class -= 1
-        if current_prio_class > 0:
-            ruleslist.extend(
-                make_base_prepend_rules(
-                    PRIORITY_CLASS_INVERSE_MAP[current_prio_class],
-                    modified_base_rules,
-                    use_new_defaults,
-                )
-            )
 
     return ruleslist
 
@@ -102,33 +71,12 @@ def make_base_append_rules(
     modified_base_rules: Dict[str, Dict[str, Any]],
     use_new_defaults: bool = False,
 ) -> List[Dict[str, Any]]:
-    rules = []
+    if use_new_defaults:
+        rules = _NEW_APPEND_RULES_BY_KIND.get(kind, [])
+    else:
+        rules = _BASE_APPEND_RULES_BY_KIND.get(kind, [])
 
-    if kind == "override":
-        rules = (
-            NEW_APPEND_OVERRIDE_RULES
-            if use_new_defaults
-            else BASE_APPEND_OVERRIDE_RULES
-        )
-    elif kind == "underride":
-        rules = (
-            NEW_APPEND_UNDERRIDE_RULES
-            if use_new_defaults
-            else BASE_APPEND_UNDERRIDE_RULES
-        )
-    elif kind == "content":
-        rules = BASE_APPEND_CONTENT_RULES
-
-    # Copy the rules before modifying them
-    rules = copy.deepcopy(rules)
-    for r in rules:
-        # Only modify the actions, keep the conditions the same.
-        assert isinstance(r["rule_id"], str)
-        modified = modified_base_rules.get(r["rule_id"])
-        if modified:
-            r["actions"] = modified["actions"]
-
-    return rules
+    return _clone_rules(rules, modified_base_rules)
 
 
 def make_base_prepend_rules(
@@ -136,21 +84,53 @@ def make_base_prepend_rules(
     modified_base_rules: Dict[str, Dict[str, Any]],
     use_new_defaults: bool = False,
 ) -> List[Dict[str, Any]]:
-    rules = []
+    rules = _PREPEND_RULES_BY_KIND.get(kind, [])
 
-    if kind == "override":
-        rules = BASE_PREPEND_OVERRIDE_RULES
+    return _clone_rules(rules, modified_base_rules)
 
-    # Copy the rules before modifying them
-    rules = copy.deepcopy(rules)
-    for r in rules:
-        # Only modify the actions, keep the conditions the same.
-        assert isinstance(r["rule_id"], str)
-        modified = modified_base_rules.get(r["rule_id"])
-        if modified:
-            r["actions"] = modified["actions"]
 
-    return rules
+def _clone_rules(
+    rules: List[Dict[str, Any]], modified_base_rules: Dict[str, Dict[str, Any]]
+) -> List[Dict[str, Any]]:
+    """Copy a list of the server default rules, applying the user's changes.
+
+    Args:
+        rules: The default rules to copy.
+        modified_base_rules: The default rules that the user has modified, by
+            rule ID.
+
+    Returns:
+        A new list of rules.
+    """
+    # Most users never change any of the default rules, so skip looking each
+    # rule up in that case.
+    if not modified_base_rules:
+        return [_clone_rule(r, None) for r in rules]
+
+    return [_clone_rule(r, modified_base_rules.get(r["rule_id"])) for r in rules]
+
+
+def _clone_rule(
+    rule: Dict[str, Any], modified: Optional[Dict[str, Any]]
+) -> Dict[str, Any]:
+    """Copy one of the server default rules so that it can be handed out.
+
+    Only the actions of a default rule can be modified by the user, so those
+    are the only part which is copied: the conditions are frozen at import
+    time and shared with the module-level rule.
+
+    Args:
+        rule: The default rule to copy.
+        modified: The user's version of the rule, if they have changed it.
+
+    Returns:
+        A new rule, using the actions of `modified` if it is set.
+    """
+    if modified:
+        actions = modified["actions"]
+    else:
+        actions = list(rule["actions"])
+    return {**rule, "actions": actions}
 
 
 BASE_APPEND_CONTENT_RULES = [
@@ -568,47 +548,53 @@ NEW_APPEND_UNDERRIDE_RULES = [
 ]
 
 
-BASE_RULE_IDS = set()
-
-for r in BASE_APPEND_CONTENT_RULES:
-    r["priority_class"] = PRIORITY_CLASS_MAP["content"]
-    r["default"] = True
-    BASE_RULE_IDS.add(r["rule_id"])
-
-for r in BASE_PREPEND_OVERRIDE_RULES:
-    r["priority_class"] = PRIORITY_CLASS_MAP["override"]
-    r["default"] = True
-    BASE_RULE_IDS.add(r["rule_id"])
-
-for r in BASE_APPEND_OVERRIDE_RULES:
-    r["priority_class"] = PRIORITY_CLASS_MAP["override"]
-    r["default"] = True
-    BASE_RULE_IDS.add(r["rule_id"])
-
-for r in BASE_APPEND_UNDERRIDE_RULES:
-    r["priority_class"] = PRIORITY_CLASS_MAP["underride"]
-    r["default"] = True
-    BASE_RULE_IDS.add(r["rule_id"])
-
-
-NEW_RULE_IDS = set()
-
-for r in BASE_APPEND_CONTENT_RULES:
-    r["priority_class"] = PRIORITY_CLASS_MAP["content"]
-    r["default"] = True
-    NEW_RULE_IDS.add(r["rule_id"])
-
-for r in BASE_PREPEND_OVERRIDE_RULES:
-    r["priority_class"] = PRIORITY_CLASS_MAP["override"]
-    r["default"] = True
-    NEW_RULE_IDS.add(r["rule_id"])
-
-for r in NEW_APPEND_OVERRIDE_RULES:
-    r["priority_class"] = PRIORITY_CLASS_MAP["override"]
-    r["default"] = True
-    NEW_RULE_IDS.add(r["rule_id"])
-
-for r in NEW_APPEND_UNDERRIDE_RULES:
-    r["priority_class"] = PRIORITY_CLASS_MAP["underride"]
-    r["default"] = True
-    NEW_RULE_IDS.add(r["rule_id"])
+# The default rules to append or prepend to the rules of each kind.
+_BASE_APPEND_RULES_BY_KIND = {
+    "override": BASE_APPEND_OVERRIDE_RULES,
+    "underride": BASE_APPEND_UNDERRIDE_RULES,
+    "content": BASE_APPEND_CONTENT_RULES,
+}  # type: Dict[str, List[Dict[str, Any]]]
+
+_NEW_APPEND_RULES_BY_KIND = {
+    "override": NEW_APPEND_OVERRIDE_RULES,
+    "underride": NEW_APPEND_UNDERRIDE_RULES,
+    "content": BASE_APPEND_CONTENT_RULES,
+}  # type: Dict[str, List[Dict[str, Any]]]
+
+_PREPEND_RULES_BY_KIND = {
+    "override": BASE_PREPEND_OVERRIDE_RULES,
+}  # type: Dict[str, List[Dict[str, Any]]]
+
+
+# Fill in the fields shared by all of the default rules. Their conditions end up
+# shared between the push rules of every user (see _clone_rule), so they are
+# frozen to ensure they can't be modified.
+_DEFAULT_RULES = (
+    ("content", BASE_APPEND_CONTENT_RULES),
+    ("override", BASE_PREPEND_OVERRIDE_RULES),
+    ("override", BASE_APPEND_OVERRIDE_RULES),
+    ("underride", BASE_APPEND_UNDERRIDE_RULES),
+    ("override", NEW_APPEND_OVERRIDE_RULES),
+    ("underride", NEW_APPEND_UNDERRIDE_RULES),
+)  # type: Tuple[Tuple[str, List[Dict[str, Any]]], ...]
+
+for kind, rules in _DEFAULT_RULES:
+    for r in rules:
+        r["priority_class"] = PRIORITY_CLASS_MAP[kind]
+        r["default"] = True
+        r["conditions"] = freeze(r["conditions"])
+
+
+BASE_RULE_IDS = frozenset(
+    r["rule_id"]
+    for rules_by_kind in (_PREPEND_RULES_BY_KIND, _BASE_APPEND_RULES_BY_KIND)
+    for rules in rules_by_kind.values()
+    for r in rules
+)
+
+NEW_RULE_IDS = frozenset(
+    r["rule_id"]
+    for rules_by_kind in (_PREPEND_RULES_BY_KIND, _NEW_APPEND_RULES_BY_KIND)
+    for rules in rules_by_kind.values()
+    for r in rules
+)
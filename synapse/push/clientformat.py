@@ -37,8 +37,11 @@ def format_push_rules_for_user(user: UserID, ruleslist) -> Dict[str, Dict[str, l
     for r in ruleslist:
         template_name = _priority_class_to_template_name(r["priority_class"])
 
-        # Remove internal stuff.
+        # Remove internal stuff. The conditions of the default rules are
+        # frozen, so build new ones rather than modifying them in place.
+        conditions = []
         for c in r["conditions"]:
+            c = dict(c)
             c.pop("_id", None)
 
             pattern_type = c.pop("pattern_type", None)
@@ -47,6 +50,9 @@ def format_push_rules_for_user(user: UserID, ruleslist) -> Dict[str, Dict[str, l
             elif pattern_type == "user_localpart":
                 c["pattern"] = user.localpart
 
+            conditions.append(c)
+        r["conditions"] = conditions
+
         rulearray = rules["global"][template_name]
 
         template_rule = _rule_to_template(r)